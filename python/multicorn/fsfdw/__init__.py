@@ -231,7 +231,8 @@ class FilesystemFdw(TransactionAwareForeignDataWrapper):
             if qual.field_name == filename_column and qual.operator == '=':
                 item = self.structured_directory.from_filename(
                     unicode_(qual.value))
-                if item is not None and os.path.exists(item.full_filename):
+                if item is not None and self.structured_directory._isfile_cached(
+                        tuple(item.filename.split('/'))):
                     return [item]
                 else:
                     return []
@@ -245,12 +246,17 @@ class FilesystemFdw(TransactionAwareForeignDataWrapper):
         filename_column = self.filename_column
         has_content = content_column and content_column in columns
         has_filename = filename_column and filename_column in columns
+        invisible_files = self.invisible_files
+        updated_content = self.updated_content
         for item in items:
-            if item.full_filename in self.invisible_files:
+            # Building the full filename formats every pattern part: do
+            # it once per item, not once per use.
+            full_filename = item.full_filename
+            if full_filename in invisible_files:
                 continue
             new_item = dict(item)
             if has_content:
-                content = self.updated_content.get(item.full_filename, None)
+                content = updated_content.get(full_filename, None)
                 if content is None:
                     content = item.read()
                 new_item[content_column] = content
@@ -387,6 +393,7 @@ class FilesystemFdw(TransactionAwareForeignDataWrapper):
         self._init_transaction_state()
         self.invisible_files = set()
         self.structured_directory.clear_cache(only_shared=False)
+        self.structured_directory.clear_listing_cache()
         self.updated_content = {}
 
     def pre_commit(self):
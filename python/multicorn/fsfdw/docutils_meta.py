@@ -47,26 +47,56 @@ def mtime_lru_cache(function, max_size=100):
     Least recently used value are dropped first. Cached values are invalidated
     when the files's modification time changes.
 
+    Concurrent misses for the same file are serialized with a per-file
+    lock, so ``function`` runs once per file instead of once per waiting
+    thread.
+
     Inspired from functools.lru_cache, which only exists in Python 3.2+.
 
     """
     lock = Lock()  # OrderedDict isn't threadsafe
     cache = OrderedDict()  # ordered least recent to most recent
+    in_flight = {}  # filename -> lock held while computing a miss
+    missing = object()  # sentinel: no valid cached value
+
+    def cached_value(filename, mtime):
+        """Return the valid cached value, or ``missing``. Call with lock
+        held."""
+        if filename in cache:
+            old_mtime, result = cache.pop(filename)
+            if old_mtime == mtime:
+                # Move to the end
+                cache[filename] = old_mtime, result
+                return result
+        return missing
 
     @wraps(function)
     def wrapper(filename):
         mtime = getmtime(filename)
         with lock:
-            if filename in cache:
-                old_mtime, result = cache.pop(filename)
-                if old_mtime == mtime:
-                    # Move to the end
-                    cache[filename] = old_mtime, result
-                    return result
-        result = function(filename)
-        with lock:
-            cache[filename] = mtime, result  # at the end
-            if len(cache) > max_size:
-                cache.popitem(last=False)
+            result = cached_value(filename, mtime)
+            if result is not missing:
+                return result
+            file_lock = in_flight.get(filename)
+            if file_lock is None:
+                file_lock = in_flight[filename] = Lock()
+        with file_lock:
+            try:
+                # Another thread may have computed the value while we were
+                # waiting for the per-file lock.
+                with lock:
+                    result = cached_value(filename, mtime)
+                    if result is not missing:
+                        return result
+                result = function(filename)
+                with lock:
+                    cache[filename] = mtime, result  # at the end
+                    if len(cache) > max_size:
+                        cache.popitem(last=False)
+            finally:
+                # Drop the per-file lock even when function() raises,
+                # or failing filenames would leak one lock each.
+                with lock:
+                    in_flight.pop(filename, None)
         return result
     return wrapper
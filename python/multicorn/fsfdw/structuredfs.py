@@ -5,16 +5,12 @@ Handle nicely a set of files in a structured directory.
 """
 import os
 import sys
-import io
 import re
 import errno
-import string
 import collections
 import fcntl
 from multicorn.compat import unicode_, basestring_
 
-vformat = string.Formatter().vformat
-
 
 try:
     str.isidentifier
@@ -39,6 +35,33 @@ else:
         return string.isidentifier()
 
 
+try:
+    os.scandir
+except AttributeError:
+    # Python < 3.5
+    # Emulate scandir() with listdir() plus one stat() per entry.
+    def _scandir_with_types(dirname):
+        for name in os.listdir(dirname):
+            yield name, os.path.isfile(os.path.join(dirname, name))
+else:
+    def _scandir_with_types(dirname):
+        """
+        Yield (name, is_file) for each entry of a directory.
+
+        The file type comes for free with the directory read on most
+        filesystems, so this saves one stat() per entry compared to
+        listdir() + isfile().
+        """
+        entries = os.scandir(dirname)
+        try:
+            for entry in entries:
+                yield entry.name, entry.is_file()
+        finally:
+            close = getattr(entries, 'close', None)
+            if close is not None:
+                close()
+
+
 def _tokenize_pattern(pattern):
     """
     Return an iterable of tokens from a string pattern.
@@ -95,7 +118,10 @@ def _tokenize_pattern(pattern):
 
 def _parse_pattern(pattern):
     r"""
-    Parse a string pattern and return (path_parts_re, path_parts_properties)
+    Parse a string pattern and return
+    (path_parts_re, path_parts_properties, path_parts_formats,
+    filename_re), where filename_re matches whole slash-joined filenames
+    in one go.
 
     >>> _parse_pattern('{category}/{number}_{name}.txt')
     (
@@ -105,7 +131,13 @@ def _parse_pattern(pattern):
         ), (
             ('category',)
             ('number', 'name')
+        ), (
+            (('property', 'category'),)
+            (('property', 'number'), ('literal', '_'),
+             ('property', 'name'), ('literal', '.txt'))
         ),
+        <re object
+         r'^(?P<category>[^/\n]*)/(?P<number>[^/\n]*)\_(?P<name>[^/\n]*)\.txt$'>
     )
     """
     # A list of list of names
@@ -117,18 +149,43 @@ def _parse_pattern(pattern):
 
     # A list of compiled re objects
     path_parts_re = []
-    # The pattern being built for the next re
-    next_re = ''
+    # Fragments of the pattern being built for the next re. Collected in
+    # a list and joined once per part: the tokenizer yields literals one
+    # character at a time, so concatenating strings would be quadratic.
+    next_re = []
+
+    # A list of tuples of ('literal', text) / ('property', name) pieces,
+    # one per part, used to build filenames without going through the
+    # string.Formatter machinery for every item.
+    path_parts_formats = []
+    # Pieces for the next part; consecutive literal characters merged.
+    next_format = []
+    literal_chars = []
+
+    # Source fragments for a single regex matching a whole slash-joined
+    # filename, with properties restricted to one path part.
+    whole_parts = []
+    next_whole = []
+
+    def flush_literal():
+        if literal_chars:
+            next_format.append(('literal', ''.join(literal_chars)))
+            del literal_chars[:]
 
     for token_type, token in _tokenize_pattern(pattern):
         if token_type == 'path separator':
             if not next_re:
                 raise ValueError('A slash-separated part is empty in %r' %
                                  pattern)
-            path_parts_re.append(re.compile('^%s$' % next_re))
-            next_re = ''
+            flush_literal()
+            path_parts_re.append(_compile_part('^%s$' % ''.join(next_re)))
+            next_re = []
             path_parts_properties.append(tuple(properties))
             properties = []
+            path_parts_formats.append(tuple(next_format))
+            next_format = []
+            whole_parts.append(''.join(next_whole))
+            next_whole = []
         elif token_type == 'property':
             if not isidentifier(token):
                 raise ValueError('Invalid property name for Filesystem: %r. '
@@ -138,9 +195,15 @@ def _parse_pattern(pattern):
                                  'in the pattern %r.' % (token, pattern))
             all_properties.add(token)
             properties.append(token)
-            next_re += '(?P<%s>.*)' % token
+            next_re.append('(?P<%s>.*)' % token)
+            flush_literal()
+            next_format.append(('property', token))
+            # Like '.*' within a single part: no slash and no newline.
+            next_whole.append('(?P<%s>[^/\n]*)' % token)
         elif token_type == 'literal':
-            next_re += re.escape(token)
+            next_re.append(re.escape(token))
+            literal_chars.append(token)
+            next_whole.append(re.escape(token))
         else:
             assert False, 'Unexpected token type: ' + token_type
 
@@ -148,7 +211,60 @@ def _parse_pattern(pattern):
     # in path_parts_re.
     assert token_type == 'path separator'
 
-    return tuple(path_parts_re), tuple(path_parts_properties)
+    return (tuple(path_parts_re), tuple(path_parts_properties),
+            tuple(path_parts_formats),
+            _compile_part('^%s$' % '/'.join(whole_parts)))
+
+
+def _format_part(part_format, values):
+    """
+    Build one filename part from its pieces and a values mapping.
+    """
+    return ''.join(
+        values[token] if token_type == 'property' else token
+        for token_type, token in part_format)
+
+
+# Compiled part regexes, interned by source. Different patterns often
+# share parts ('{category}/{num}_{name}.txt' and '{category}/...' both
+# use '^(?P<category>.*)$'), so the Pattern objects are shared too.
+_PART_RES = {}
+
+
+def _compile_part(source):
+    """
+    Compile (or reuse) the regex for one slash-separated pattern part.
+    """
+    try:
+        return _PART_RES[source]
+    except KeyError:
+        part_re = _PART_RES[source] = re.compile(source)
+        return part_re
+
+
+def _stat_key(st):
+    """
+    The part of a stat() result used to detect directory changes.
+    st_mtime_ns is not available before Python 3.3.
+    """
+    return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+
+
+# Cache of successfully parsed patterns. Every PostgreSQL backend builds
+# its own FilesystemFdw (and thus StructuredDirectory) instances, but the
+# set of distinct patterns is small, so the compiled regexes are shared.
+_PARSED_PATTERNS = {}
+
+
+def _parse_pattern_cached(pattern):
+    """
+    Memoized version of :func:`_parse_pattern`.
+    """
+    try:
+        return _PARSED_PATTERNS[pattern]
+    except KeyError:
+        result = _PARSED_PATTERNS[pattern] = _parse_pattern(pattern)
+        return result
 
 
 def strict_unicode(value):
@@ -174,15 +290,18 @@ class Item(collections.Mapping):
     def __init__(self, directory, properties, content=b''):
         properties = dict(properties)
         keys = set(properties)
-        missing = directory.properties - keys
-        if missing:
-            raise ValueError('Missing properties: %s', ', '.join(missing))
-        extra = keys - directory.properties
-        if extra:
+        # One C-level set comparison on the common (valid) path; the two
+        # set differences are only computed to report an error.
+        if keys != directory.properties:
+            missing = directory.properties - keys
+            if missing:
+                raise ValueError('Missing properties: %s', ', '.join(missing))
+            extra = keys - directory.properties
             raise ValueError('Unknown properties: %s', ', '.join(extra))
         self.directory = directory
         self._properties = {}
         self.content = content
+        self._parts_cache = None
         # TODO: check for ambiguities.
         # eg. with pattern = '{a}_{b}', values {'a': '1_2', 'b': '3'} and
         # {'a': '1', 'b': '2_3'} both give the same filename.
@@ -192,20 +311,48 @@ class Item(collections.Mapping):
                 raise ValueError('Property values can not contain a slash.')
             self._properties[name] = value
 
+    @classmethod
+    def _from_parsed(cls, directory, properties):
+        """
+        Build an Item from values parsed out of a filename, skipping
+        per-value validation: values matched from a path part are
+        already text and can not contain a slash.
+        """
+        item = cls.__new__(cls)
+        item.directory = directory
+        item._properties = dict(properties)
+        item.content = b''
+        item._parts_cache = None
+        return item
+
+    def _filename_parts(self):
+        """
+        Return the formatted filename parts for the item, one per
+        slash-separated part of the pattern. Computed once per item and
+        cached until a property changes.
+        """
+        parts = self._parts_cache
+        if parts is None:
+            properties = self._properties
+            parts = self._parts_cache = tuple(
+                _format_part(part_format, properties)
+                for part_format in self.directory._path_parts_formats)
+        return parts
+
     @property
     def filename(self):
         """
         Return the normalized (slash-separated) filename for the item,
         relative to the root.
         """
-        return vformat(self.directory.pattern, [], self)
+        return '/'.join(self._filename_parts())
 
     @property
     def full_filename(self):
         """
         Return the absolute filename for the item, in OS-specific form.
         """
-        return self.directory._join(self.filename.split('/'))
+        return self.directory._join(self._filename_parts())
 
     def open(self, shared_lock=True, fail_if=None):
         """Open the file underlying this item, if it is not in the cache.
@@ -230,9 +377,15 @@ class Item(collections.Mapping):
                 # Open it with an exclusive lock, sync mode, and fail if the
                 # file already exists.
                 dirname = os.path.dirname(self.full_filename)
-                if not os.path.exists(dirname):
-                    umask = os.umask(0)
+                # Let makedirs() report an existing directory instead of
+                # paying a stat() to check first.
+                umask = os.umask(0)
+                try:
                     os.makedirs(dirname, self.directory.file_mode)
+                except OSError as exc:
+                    if exc.errno != errno.EEXIST:
+                        raise
+                finally:
                     os.umask(umask)
                 flags = os.O_SYNC | os.O_RDWR
                 if fail_if == 'exists':
@@ -257,28 +410,38 @@ class Item(collections.Mapping):
         :raises IOError: if the file does not exist in the filesystem.
         """
         fd = self.open(True, fail_if='missing')
+        # Read the whole file in (usually) one syscall of the right size,
+        # without building a buffered reader object per call. The locks
+        # taken in open() guarantee the size can not change under us.
+        size = os.fstat(fd).st_size
         os.lseek(fd, 0, os.SEEK_SET)
-        iof = io.open(fd, 'rb', closefd=False)
-        content = iof.read()
-        iof.close()
-        return content
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = os.read(fd, remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
 
     def write(self, fd=None):
         if fd is None:
             fd = self.open(False)
         os.ftruncate(fd, 0)
         os.lseek(fd, 0, os.SEEK_SET)
-        # Do not use a buffer, to ensure that the file is written in one
-        # syscall.
-        iof = io.open(fd, 'wb', closefd=False,
-                      buffering=0)
 
         if isinstance(self.content, unicode_):
             self.content = self.content.encode(sys.getfilesystemencoding())
 
-        if self.content is not None:
-            iof.write(self.content)
-        iof.close()
+        # Write with bare os.write() so that the whole content normally
+        # goes to the kernel in one syscall, without a file object.
+        data = self.content
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
 
     def remove(self):
         os.unlink(self.full_filename)
@@ -296,6 +459,7 @@ class Item(collections.Mapping):
 
     def __setitem__(self, name, value):
         self._properties[name] = value
+        self._parts_cache = None
 
 
 class StructuredDirectory(object):
@@ -309,12 +473,30 @@ class StructuredDirectory(object):
         self.pattern = unicode_(pattern)
         # Cache for file descriptors.
         self.cache = {}
-        parts_re, parts_properties = _parse_pattern(self.pattern)
+        # Cache for directory listings, keyed by path parts relative to
+        # the root. See _listdir_cached().
+        self._listing_cache = {}
+        # Negative cache for leaf files: full filename -> stat key of the
+        # parent directory when the file was found missing.
+        self._missing_cache = {}
+        parts_re, parts_properties, parts_formats, filename_re = (
+            _parse_pattern_cached(self.pattern))
         self.file_mode = file_mode
         self._path_parts_re = parts_re
         self._path_parts_properties = parts_properties
-        self.properties = set(prop for part in parts_properties
-                              for prop in part)
+        self._path_parts_formats = parts_formats
+        # A single regex matching whole slash-joined filenames, so
+        # from_filename() does one match instead of a split and one
+        # match per part.
+        self._filename_re = filename_re
+        # One record per path depth, so per-request code walks a single
+        # prebuilt structure instead of zipping parallel tuples.
+        self._parts_info = tuple(zip(
+            parts_formats, parts_properties, parts_re))
+        # The `fixed` argument of _walk() for a scan with no fixed value.
+        self._no_fixed = ((None, ()),) * len(parts_re)
+        self.properties = frozenset(prop for part in parts_properties
+                                    for prop in part)
 
     def create(self, **values):
         """
@@ -340,16 +522,10 @@ class StructuredDirectory(object):
         The file for this item may or may not exist.
 
         """
-        values = {}
-        parts = filename.split('/')
-        if len(parts) != len(self._path_parts_re):
+        match = self._filename_re.match(filename)
+        if match is None:
             return None
-        for part, part_re in zip(parts, self._path_parts_re):
-            match = part_re.match(part)
-            if match is None:
-                return None
-            values.update(match.groupdict())
-        return Item(self, values)
+        return Item._from_parsed(self, match.groupdict())
 
     def get_items(self, **fixed_values):
         """
@@ -361,6 +537,20 @@ class StructuredDirectory(object):
         if extra:
             raise ValueError('Unknown properties: %s', ', '.join(extra))
 
+        if not fixed_values:
+            # Full scan: nothing to pre-compute, reuse the prebuilt
+            # all-unfixed structure.
+            return self._walk((), (), self._no_fixed)
+
+        # Validate the fixed values once here: they end up in items built
+        # with Item._from_parsed(), which skips per-value checks on the
+        # (per-entry) hot path.
+        for name, value in list(fixed_values.items()):
+            value = strict_unicode(value)
+            if '/' in value:
+                raise ValueError('Property values can not contain a slash.')
+            fixed_values[name] = value
+
         # Pre-compute everything we know about the request without looking
         # at the filesystem.
 
@@ -370,15 +560,15 @@ class StructuredDirectory(object):
         #    fixed_part_values: (name, value) pairs for$ fixed values
         #                       for this part.
         fixed = []
-        for pattern_part, part_properties in zip(
-                self.pattern.split('/'), self._path_parts_properties):
+        for part_format, part_properties, _part_re in self._parts_info:
             fixed_part_values = tuple(
                 (name, fixed_values[name]) for name in part_properties
                 if name in fixed_values
             )
             if len(fixed_part_values) == len(part_properties):
                 # All properties for this part are fixed
-                fixed_part = vformat(pattern_part, [], dict(fixed_part_values))
+                fixed_part = _format_part(part_format,
+                                          dict(fixed_part_values))
             else:
                 fixed_part = None
             fixed.append((fixed_part, fixed_part_values))
@@ -403,15 +593,21 @@ class StructuredDirectory(object):
         # If the pattern has N path parts, "leaf" files are at depth = N-1
         is_leaf = (depth == len(self._path_parts_re) - 1)
 
-        for name, part_values in self._find_matching_names(
+        # Bound to locals outside the loop: hit once per directory entry.
+        from_parsed = Item._from_parsed
+        isfile_cached = self._isfile_cached
+        for name, part_values, is_file in self._find_matching_names(
                 previous_path_parts, fixed):
             path_parts = previous_path_parts + (name,)
             values = previous_values + tuple(part_values)
-            filename = self._join(path_parts)
             if is_leaf:
-                if os.path.isfile(filename):
-                    yield Item(self, values)
-            # Do not check if filename is a directory or even exists,
+                if is_file is None:
+                    # The name was inferred from fixed values, not read
+                    # from the directory: we have no cached type for it.
+                    is_file = isfile_cached(path_parts)
+                if is_file:
+                    yield from_parsed(self, values)
+            # Do not check if the name is a directory or even exists,
             # let listdir() raise later.
             else:
                 for item in self._walk(path_parts, values, fixed):
@@ -419,16 +615,18 @@ class StructuredDirectory(object):
 
     def _find_matching_names(self, previous_path_parts, fixed):
         """
-        Yield names and parsed values that match the request in a directory.
+        Yield (name, parsed values, is_file) that match the request in a
+        directory. ``is_file`` is None when the name was not read from the
+        directory and its type is unknown.
         """
         depth = len(previous_path_parts)
         fixed_part, fixed_part_values = fixed[depth]
         if fixed_part is not None:
-            yield fixed_part, fixed_part_values
+            yield fixed_part, fixed_part_values, None
             return
 
         try:
-            names = self._listdir(previous_path_parts)
+            entries = self._listdir_cached(previous_path_parts)
         except OSError as exc:
             if depth > 0 and exc.errno in [errno.ENOENT, errno.ENOTDIR]:
                 # Does not exist or is not a directory, just return
@@ -439,15 +637,26 @@ class StructuredDirectory(object):
             else:
                 # Re-raise other errors
                 raise
-        for name in names:
-            match = self._path_parts_re[depth].match(name)
-            if match is None:
-                continue
-
-            part_values = match.groupdict()
-            if all(part_values[name] == value
-                   for name, value in fixed_part_values):
-                yield name, list(part_values.items())
+        # This loop runs once per directory entry: bind the match method
+        # to a local and only filter on fixed values when there are any,
+        # so the common case is a plain C-level Pattern.match per name.
+        part_match = self._path_parts_re[depth].match
+        if fixed_part_values:
+            for name, is_file in entries:
+                match = part_match(name)
+                if match is None:
+                    continue
+                part_values = match.groupdict()
+                for prop, value in fixed_part_values:
+                    if part_values[prop] != value:
+                        break
+                else:
+                    yield name, list(part_values.items()), is_file
+        else:
+            for name, is_file in entries:
+                match = part_match(name)
+                if match is not None:
+                    yield name, list(match.groupdict().items()), is_file
 
     def _join(self, path_parts):
         """
@@ -458,6 +667,59 @@ class StructuredDirectory(object):
 
     def _listdir(self, path_parts):
         """
-        Wrap os.listdir to make it monkey-patchable in tests.
+        List a directory and return (name, is_file) pairs.
+
+        Wrapped in a method to make it monkey-patchable in tests.
+        """
+        return list(_scandir_with_types(self._join(path_parts)))
+
+    def _listdir_cached(self, path_parts):
+        """
+        Same as _listdir, but reuse a previous listing as long as the
+        directory's mtime and size are unchanged. The validating stat()
+        raises OSError just like the listing itself would, so callers
+        handle missing directories the same way.
+        """
+        st = os.stat(self._join(path_parts))
+        key = _stat_key(st)
+        cached = self._listing_cache.get(path_parts)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        entries = self._listdir(path_parts)
+        self._listing_cache[path_parts] = (key, entries)
+        return entries
+
+    def _isfile_cached(self, path_parts):
+        """
+        Like os.path.isfile() on a path relative to the root, answering
+        from the cached parent listing when a valid one exists, and
+        remembering misses so a known-missing file costs a single stat()
+        of its parent directory until that directory changes.
+        """
+        parent = path_parts[:-1]
+        try:
+            key = _stat_key(os.stat(self._join(parent)))
+        except OSError:
+            return False
+        cached = self._listing_cache.get(parent)
+        if cached is not None and cached[0] == key:
+            name = path_parts[-1]
+            for entry_name, is_file in cached[1]:
+                if entry_name == name:
+                    return is_file
+            return False
+        filename = self._join(path_parts)
+        if self._missing_cache.get(filename) == key:
+            return False
+        if os.path.isfile(filename):
+            self._missing_cache.pop(filename, None)
+            return True
+        self._missing_cache[filename] = key
+        return False
+
+    def clear_listing_cache(self):
+        """
+        Drop all cached directory listings and known-missing files.
         """
-        return os.listdir(self._join(path_parts))
+        self._listing_cache.clear()
+        self._missing_cache.clear()
@@ -206,6 +206,12 @@ def test_get_items(tempdir):
     with assert_raises(ValueError, 'Unknown properties'):
         filenames(fiz='5')
 
+    with assert_raises(ValueError, 'can not contain a slash'):
+        filenames(category='lipsum/4_foo.txt')
+
+    with assert_raises(TypeError, 'must be of type unicode'):
+        filenames(num=4)
+
 
 @with_tempdir
 def test_from_filename(tempdir):
@@ -251,6 +257,9 @@ def test_optimizations(tempdir):
         contents[values['id']] = content
 
     def assert_listed(properties, expected_ids, expected_listed):
+        # This test is about which directories are read, not about the
+        # mtime-based listing cache: start from a cold cache every time.
+        text.clear_listing_cache()
         del listed[:]
         expected_contents = set(contents[num] for num in expected_ids)
         results = [item.read() for item in text.get_items(**properties)]
@@ -302,10 +311,84 @@ def test_optimizations(tempdir):
         ['2'],
         ['', 'lipsum', 'dolor', 'lipsum/b_foo'])
 
-    # Does not list the root and directry tries to list 'nonexistent'
+    # Does not list the root, and the missing 'nonexistent' directory is
+    # detected by the validating stat() without a listing attempt.
     assert_listed(dict(cat='nonexistent'),
         [],
-        ['nonexistent'])
+        [])
+
+
+@with_tempdir
+def test_listing_cache(tempdir):
+    """
+    Test that directory listings are cached between scans and invalidated
+    when a directory changes.
+    """
+    text = StructuredDirectory(tempdir, '{category}/{num}_{name}.txt')
+
+    listed = []
+    real_listdir = text._listdir
+
+    def listdir_mock(parts):
+        listed.append('/'.join(parts))
+        return real_listdir(parts)
+
+    text._listdir = listdir_mock
+
+    def filenames():
+        return sorted(i.filename for i in text.get_items())
+
+    item = text.create(category='lipsum', num='4', name='foo')
+    item.content = 'FOO'
+    item.write()
+
+    assert filenames() == ['lipsum/4_foo.txt']
+    assert listed == ['', 'lipsum']
+
+    # A second scan of an unchanged tree hits the cache.
+    del listed[:]
+    assert filenames() == ['lipsum/4_foo.txt']
+    assert listed == []
+
+    # Changing a directory invalidates its cached listing.
+    item2 = text.create(category='lipsum', num='5', name='bar')
+    item2.content = 'BAR'
+    item2.write()
+    del listed[:]
+    assert filenames() == ['lipsum/4_foo.txt', 'lipsum/5_bar.txt']
+    assert listed == ['lipsum']
+
+    # An explicit clear drops everything.
+    text.clear_listing_cache()
+    del listed[:]
+    assert filenames() == ['lipsum/4_foo.txt', 'lipsum/5_bar.txt']
+    assert listed == ['', 'lipsum']
+
+
+@with_tempdir
+def test_missing_file_cache(tempdir):
+    """
+    Test that known-missing files are remembered and re-checked when their
+    parent directory changes.
+    """
+    text = StructuredDirectory(tempdir, '{category}/{num}_{name}.txt')
+    properties = dict(category='lipsum', num='4', name='foo')
+
+    def filenames():
+        return [i.filename for i in text.get_items(**properties)]
+
+    os.mkdir(os.path.join(tempdir, 'lipsum'))
+    # All properties fixed: existence is checked without any listing,
+    # and the miss is cached.
+    assert filenames() == []
+    assert filenames() == []
+
+    # Creating the file changes the parent directory, which invalidates
+    # the negative entry.
+    item = text.create(**properties)
+    item.content = 'FOO'
+    item.write()
+    assert filenames() == ['lipsum/4_foo.txt']
 
 
 @with_tempdir
@@ -368,5 +451,37 @@ Content
     assert counting.n_calls == 5
 
 
+@with_tempdir
+def test_mtime_cache_stampede(tempdir):
+    """
+    Test that concurrent cache misses for the same file only compute once.
+    """
+    import threading
+    import time
+
+    calls = []
+
+    def slow(filename):
+        calls.append(filename)
+        time.sleep(0.05)
+        return {'title': 'computed'}
+
+    wrapper = mtime_lru_cache(slow, max_size=2)
+    filename = os.path.join(tempdir, 'doc.rst')
+    with open(filename, 'w') as file_obj:
+        file_obj.write('content')
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        wrapper(filename))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{'title': 'computed'}] * 4
+    assert len(calls) == 1
+
+
 if __name__ == '__main__':
     pytest.main([__file__] + sys.argv)